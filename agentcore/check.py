@@ -0,0 +1,87 @@
+from __future__ import annotations
+from typing import Optional
+
+
+class Check:
+    """Compact representation of a check as received from the hub.
+
+    The probe config is not merged with the check config but shared by all
+    checks of the asset; the config dict for a probe collector is created
+    only when the check is encoded.
+    """
+
+    __slots__ = (
+        'asset_id',
+        'check_id',
+        'asset_name',
+        'check_key',
+        'interval',
+        'probe_config',
+        'check_config',
+    )
+
+    def __init__(
+            self,
+            asset_id: int,
+            check_id: int,
+            asset_name: str,
+            check_key: str,
+            interval: int,
+            probe_config: Optional[dict],
+            check_config: Optional[dict]):
+        self.asset_id = asset_id
+        self.check_id = check_id
+        self.asset_name = asset_name
+        self.check_key = check_key
+        self.interval = interval
+        self.probe_config = probe_config or None  # can be empty
+        self.check_config = check_config or None  # can be empty
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Check):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def _key(self) -> tuple:
+        # compare the config as sent to the probe collector; checks restored
+        # with `from_list` have the probe config merged in the check config
+        return (
+            self.asset_id,
+            self.check_id,
+            self.asset_name,
+            self.check_key,
+            self.interval,
+            self._config(),
+        )
+
+    def _config(self) -> dict:
+        return {
+            **(self.probe_config or {}),
+            **(self.check_config or {}),
+        }
+
+    def to_list(self) -> list:
+        """Returns the check as sent to a probe collector."""
+        return [
+            [self.asset_id, self.check_id],
+            [self.asset_name, self.check_key],
+            {
+                '_interval': self.interval,
+                **self._config(),
+            },
+        ]
+
+    @classmethod
+    def from_list(cls, check: list) -> Check:
+        """Returns a check from the format sent to a probe collector."""
+        (asset_id, check_id), (asset_name, check_key), config = check
+        config = dict(config)
+        interval = config.pop('_interval')
+        return cls(
+            asset_id,
+            check_id,
+            asset_name,
+            check_key,
+            interval,
+            None,
+            config)
@@ -2,17 +2,55 @@ import asyncio
 import json
 import logging
 import os
+import random
 import ssl
+import time
 import msgpack
-from typing import Optional, Tuple, Any
+from typing import Optional, Tuple, Dict, List, Any
+from . import codec
 from .loop import loop
 from .net.package import Package
-from .hubprotocol import HubProtocol, RespException
-from .state import State
+from .hubprotocol import HubProtocol, RespException, HUB_KEEPALIVE_PING
+from .hubqueue import HubQueue, FairQueue, SpoolQueue
+from .state import State, ASSETS_SNAPSHOT_INTERVAL
+from .tls import HubContext
 
 HUB_QUEUE_SIZE = 100_000
 HUB_QUEUE_SLEEP = .001
 HUB_MAX_ERR = 5
+HUB_RECONNECT_BASE = 1  # seconds; backoff doubles with each failed attempt
+HUB_RECONNECT_MAX = 128  # seconds
+# a close by the hub only reconnects fast when the connection was up for at
+# least this number of seconds; a hub shedding load keeps the backoff
+HUB_RECONNECT_MIN_UP = 30  # seconds
+
+# Number of data requests which may be outstanding (unacknowledged) at once
+HUB_WINDOW = max(int(os.getenv('HUB_WINDOW', 1)), 1)
+
+# Pack up to HUB_BATCH_COUNT packages (or HUB_BATCH_BYTES) in a single data
+# request when supported by the hub; wait at most HUB_BATCH_LINGER seconds
+# for a batch to fill up (HUB_BATCH_COUNT=1 disables batching)
+HUB_BATCH_COUNT = max(int(os.getenv('HUB_BATCH_COUNT', 1)), 1)
+HUB_BATCH_BYTES = int(os.getenv('HUB_BATCH_BYTES', 1 << 20))
+HUB_BATCH_LINGER = float(os.getenv('HUB_BATCH_LINGER', 0.05))
+
+# Compression of data requests; `none`, `auto` or a codec (`zlib`, `lz4`,
+# `zstd`); the codec must be accepted by the hub. Requests smaller than
+# HUB_COMPRESSION_MIN bytes are sent uncompressed.
+HUB_COMPRESSION = os.getenv('HUB_COMPRESSION', 'none').lower()
+HUB_COMPRESSION_MIN = int(os.getenv('HUB_COMPRESSION_MIN', 1024))
+
+# High water mark in bytes for the write buffer of the hub connection; data
+# producers wait when the buffer exceeds this size (0 = asyncio default)
+HUB_WRITE_BUFFER_HIGH = int(os.getenv('HUB_WRITE_BUFFER_HIGH', 0))
+
+# Interval in seconds for logging hub queue statistics (0 = disabled)
+HUB_STATS_INTERVAL = int(os.getenv('HUB_STATS_INTERVAL', 300))
+
+# on shutdown, time in seconds for sending the queue to the hub before the
+# remaining packages are written to disk; 0 disables draining
+HUB_DRAIN_TIMEOUT = float(os.getenv('HUB_DRAIN_TIMEOUT', 0))
+HUB_DRAIN_STALL = 10  # seconds without progress before draining stops
 
 HUB_HOST = os.getenv('HUB_HOST', 'hub.infrasonar.com')
 HUB_PORT = int(os.getenv('HUB_PORT', 8730))
@@ -20,8 +58,44 @@ HUB_PORT = int(os.getenv('HUB_PORT', 8730))
 AGENTCORE_DATA = os.getenv('AGENTCORE_DATA', '/data')
 AGENTCORE_JSON_FN = os.path.join(AGENTCORE_DATA, '.agentcore.json')
 AGENTCORE_QUEUE_FN = os.path.join(AGENTCORE_DATA, 'queue.mp')
+# start of a queue file with packages written one after another; 0xc1 is never
+# used in msgpack so older (msgpack) queue files are recognized
+QUEUE_MAGIC = b'\xc1acq\x01'
 AGENTCORE_ASSETS_FN = os.path.join(AGENTCORE_DATA, 'assets.mp')
 
+# Memory budget in bytes for the (in-memory) hub queue
+HUB_QUEUE_MAX_BYTES = int(os.getenv('HUB_QUEUE_MAX_BYTES', 1 << 29))
+
+# Scheduling of the (in-memory) hub queue; `fifo` or `fair` (per probe)
+HUB_QUEUE_SCHEDULER = os.getenv('HUB_QUEUE_SCHEDULER', 'fifo').lower()
+
+# Probe weights for the fair scheduler, for example: `vmwareprobe=2,wmiprobe=1`
+HUB_QUEUE_WEIGHTS = {
+    key.strip(): max(int(weight), 1)
+    for key, weight in (
+        item.split('=')
+        for item in os.getenv('HUB_QUEUE_WEIGHTS', '').split(',')
+        if item.strip())
+}
+
+# Policy when the hub queue fills up; `drop` (drop the oldest data) or
+# `pause` (stop reading from probes between the high and low watermark)
+HUB_QUEUE_OVERFLOW = os.getenv('HUB_QUEUE_OVERFLOW', 'drop').lower()
+HUB_QUEUE_HIGH = float(os.getenv('HUB_QUEUE_HIGH', 0.9))
+HUB_QUEUE_LOW = float(os.getenv('HUB_QUEUE_LOW', 0.7))
+
+# Keep only the newest N dumps for each check in the (in-memory) hub queue;
+# older dumps for the same check are superseded (0 = disabled)
+HUB_QUEUE_COALESCE = int(os.getenv('HUB_QUEUE_COALESCE', 0))
+
+# Queue backend; `memory` or `spool` (disk backed, survives a crash)
+HUB_QUEUE_BACKEND = os.getenv('HUB_QUEUE_BACKEND', 'memory').lower()
+HUB_SPOOL_PATH = os.getenv(
+    'HUB_SPOOL_PATH', os.path.join(AGENTCORE_DATA, 'spool'))
+HUB_SPOOL_MAX_BYTES = int(os.getenv('HUB_SPOOL_MAX_BYTES', 1 << 30))
+HUB_SPOOL_SEGMENT_SIZE = int(os.getenv('HUB_SPOOL_SEGMENT_SIZE', 1 << 24))
+HUB_SPOOL_FSYNC = float(os.getenv('HUB_SPOOL_FSYNC', 1.0))
+
 if not os.path.exists(AGENTCORE_JSON_FN):
     logging.info('agentcore JSON file not found. creating a new one')
     try:
@@ -39,20 +113,63 @@ if not os.path.exists(AGENTCORE_HUB_CRT):
 
 
 class Agentcore:
-    queue: asyncio.Queue
+    queue: HubQueue
     _connecting: bool
     _protocol: Optional[HubProtocol]
     _queue_fut: Optional[asyncio.Future]
     _connect_fut: Optional[asyncio.Future]
-    _pkg: Optional[Package]
+    _stats_fut: Optional[asyncio.Future]
+    _snapshot_fut: Optional[asyncio.Future]
+    _draining: bool
+    _tls: HubContext
+    _reconnect: Optional[asyncio.Event]
+    _clean_close: bool
+    _in_flight: Dict[asyncio.Future, List[Package]]
+    _window: Optional[asyncio.Semaphore]
+    _drained: int
+    _legacy_announce: bool
+    _compressed: int
 
     def __init__(self):
-        self.queue = asyncio.Queue(maxsize=HUB_QUEUE_SIZE)
+        if HUB_QUEUE_BACKEND == 'spool':
+            self.queue = SpoolQueue(
+                path=HUB_SPOOL_PATH,
+                max_bytes=HUB_SPOOL_MAX_BYTES,
+                segment_size=HUB_SPOOL_SEGMENT_SIZE,
+                fsync_interval=HUB_SPOOL_FSYNC)
+        elif HUB_QUEUE_SCHEDULER == 'fair':
+            self.queue = FairQueue(
+                maxsize=HUB_QUEUE_SIZE,
+                max_bytes=HUB_QUEUE_MAX_BYTES,
+                coalesce=HUB_QUEUE_COALESCE,
+                weights=HUB_QUEUE_WEIGHTS)
+        else:
+            self.queue = HubQueue(
+                maxsize=HUB_QUEUE_SIZE,
+                max_bytes=HUB_QUEUE_MAX_BYTES,
+                coalesce=HUB_QUEUE_COALESCE)
+        if HUB_QUEUE_OVERFLOW == 'pause':
+            # the oldest data is still dropped when the queue is full
+            self.queue.set_watermarks(
+                high=HUB_QUEUE_HIGH,
+                low=HUB_QUEUE_LOW,
+                on_high=State.pause_probes,
+                on_low=State.resume_probes)
         self._connecting = False
         self._protocol = None
         self._queue_fut = None
         self._connect_fut = None
-        self._pkg = None
+        self._stats_fut = None
+        self._snapshot_fut = None
+        self._draining = False
+        self._reconnect = None
+        self._clean_close = False
+        self._tls = HubContext(AGENTCORE_HUB_CRT)
+        self._in_flight = {}
+        self._window = None
+        self._drained = 0
+        self._legacy_announce = False
+        self._compressed = 0  # bytes saved by compression
         self._read_json()
 
     def is_connected(self) -> bool:
@@ -67,28 +184,78 @@ class Agentcore:
             asyncio.ensure_future(self._empty_queue_loop(), loop=loop)
         self._connect_fut = \
             asyncio.ensure_future(self._reconnect_loop(), loop=loop)
+        if HUB_STATS_INTERVAL > 0:
+            self._stats_fut = \
+                asyncio.ensure_future(self._stats_loop(), loop=loop)
+        if ASSETS_SNAPSHOT_INTERVAL > 0:
+            self._snapshot_fut = \
+                asyncio.ensure_future(State.snapshot_loop(), loop=loop)
+
+    def on_connection_lost(
+            self,
+            exc: Optional[Exception],
+            closed_locally: bool = False):
+        """Called by the hub protocol; wakes up the reconnect loop."""
+        if closed_locally:
+            logging.warning('hub connection closed by agentcore')
+        elif exc is None:
+            logging.warning('hub connection closed by hub')
+        else:
+            msg = str(exc) or type(exc).__name__
+            logging.error(f'hub connection lost: {msg}')
+        # only a close by the hub takes the fast path; when the agentcore
+        # closed the connection, the hub is probably not healthy
+        self._clean_close = exc is None and not closed_locally
+        if self._reconnect is not None:
+            self._reconnect.set()
 
     async def _reconnect_loop(self):
-        initial_step = 2
-        step = 2
-        max_step = 2 ** 7
+        """Connects to the hub and reconnects as soon as the connection is
+        lost; failed attempts back off exponentially with full jitter so
+        agentcores do not reconnect in waves after a hub outage."""
+        self._reconnect = asyncio.Event()
+        attempt = 0
         while True:
-            if not self.is_connected() and not self._connecting:
-                asyncio.ensure_future(self._connect())
-                step = min(step * 2, max_step)
-            else:
-                step = initial_step
-            for _ in range(step):
-                await asyncio.sleep(1)
+            if self.is_connected():
+                connected_at = loop.time()
+                self._reconnect.clear()
+                await self._reconnect.wait()
+                if self.is_connected():
+                    continue  # an older connection was closed
+                up = loop.time() - connected_at
+                if self._clean_close and up >= HUB_RECONNECT_MIN_UP:
+                    # fast path, for example when the hub is restarted;
+                    # only spread the reconnects a little
+                    attempt = 0
+                    await asyncio.sleep(random.uniform(0, 1))
+                elif up > HUB_RECONNECT_MAX:
+                    attempt = 1  # the connection was fine for a while
+                else:
+                    # connections keep failing; continue backing off
+                    attempt += 1
+
+            if attempt:
+                cap = min(HUB_RECONNECT_MAX, HUB_RECONNECT_BASE * 2 ** attempt)
+                delay = random.uniform(0, cap)
+                logging.info(f'reconnect to hub in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+            await self._connect()
+            if not self.is_connected():
+                attempt += 1
 
     async def _connect(self):
         if self._connecting:
             return
         self._connecting = True
 
-        ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        ctx.check_hostname = False
-        ctx.load_verify_locations(AGENTCORE_HUB_CRT)
+        try:
+            ctx = self._tls.get()
+        except Exception as e:
+            msg = str(e) or type(e).__name__
+            logging.error(f'failed to load {AGENTCORE_HUB_CRT}: {msg}')
+            self._connecting = False
+            return
 
         conn = loop.create_connection(
             HubProtocol,
@@ -98,45 +265,91 @@ class Agentcore:
         )
 
         try:
-            _, self._protocol = await asyncio.wait_for(conn, timeout=10)
+            t0 = time.time()
+            transport, self._protocol = \
+                await asyncio.wait_for(conn, timeout=10)
+            if HUB_WRITE_BUFFER_HIGH:
+                transport.set_write_buffer_limits(high=HUB_WRITE_BUFFER_HIGH)
+            ssl_object = transport.get_extra_info('ssl_object')
+            reused = ssl_object is not None and ssl_object.session_reused
+            logging.info(
+                f'connected to hub in {(time.time() - t0) * 1000:.0f}ms '
+                f'(TLS session reused: {"yes" if reused else "no"})')
         except Exception as e:
             msg = str(e) or type(e).__name__
             logging.error(f'connecting to hub failed: {msg}')
+            if isinstance(e, ssl.SSLError):
+                # the stored session might be the problem; next time a full
+                # handshake is done
+                self._tls.clear_session()
             if State.assets_fn is None:
                 State.assets_fn = AGENTCORE_ASSETS_FN
                 State.load_probe_assets()
-                State.remove_assets_fn()
+                if not ASSETS_SNAPSHOT_INTERVAL:
+                    State.remove_assets_fn()
         else:
-            pkg = Package.make(
-                HubProtocol.PROTO_REQ_ANNOUNCE,
-                data=[
-                    State.agentcore_id,
-                    State.name,
-                    State.zone,
-                    State.token
-                ]
-            )
+            data = [
+                State.agentcore_id,
+                State.name,
+                State.zone,
+                State.token
+            ]
+            features = self._features()
+            if features and not self._legacy_announce:
+                # older hubs do not know about features; they will simply
+                # not include features in the announce response
+                data.append(features)
+            pkg = Package.make(HubProtocol.PROTO_REQ_ANNOUNCE, data=data)
             if self.is_connected():
                 try:
                     await self._protocol.request(pkg, timeout=10)
                 except Exception as e:
                     msg = str(e) or type(e).__name__
                     logging.error(f'failed to announce: {msg}')
+                    # an older hub might also drop the announce or the
+                    # connection instead of responding with an error
+                    if len(data) > 4:
+                        logging.warning(
+                            'next announce will be without features')
+                        self._legacy_announce = True
                     self.close_protocol()
                 else:
+                    # the session ticket (TLS 1.3) has arrived by now
+                    self._tls.save_session(
+                        transport.get_extra_info('ssl_object'))
                     self._dump_json()
                     State.assets_fn = AGENTCORE_ASSETS_FN
-                    State.remove_assets_fn()
+                    if not ASSETS_SNAPSHOT_INTERVAL:
+                        # with snapshots the file is kept up-to-date
+                        State.remove_assets_fn()
         finally:
             self._connecting = False
 
+    def _features(self) -> Dict[str, Any]:
+        """Features which are offered to the hub on announce."""
+        features = {}
+        if HUB_BATCH_COUNT > 1:
+            features['batch'] = True
+        codecs = codec.available(HUB_COMPRESSION)
+        if codecs:
+            features['codecs'] = codecs
+        if HUB_KEEPALIVE_PING:
+            features['ping'] = True
+        return features
+
+    def _hub_supports(self, feature: str) -> bool:
+        return self._protocol is not None and \
+            bool(self._protocol.features.get(feature))
+
     async def request(self, protocol: int, data: Any) -> Any:
         pkg = Package.make(
             protocol,
             data=data
         )
-        assert self._protocol
-        resp = await self._protocol.request(pkg, timeout=10)
+        hub = self._protocol
+        assert hub
+        await hub.drain()
+        resp = await hub.request(pkg, timeout=10)
         return resp
 
     async def upload_file(self, data: Any):
@@ -153,21 +366,72 @@ class Agentcore:
             data=data
         )
         if self._protocol and self._protocol.transport:
-            self._protocol.transport.write(pkg.to_bytes())
+            asyncio.ensure_future(self._write_audit_log(self._protocol, pkg))
         else:
             logging.error('failed to write audit log, no connection with hub')
 
-    async def _ensure_write_pkg(self):
-        """This will write the "current" package to the hub.
-        It will try as long as is required
+    @staticmethod
+    async def _write_audit_log(protocol: HubProtocol, pkg: Package):
+        # wait while the transport buffer is above the high water mark;
+        # waiters are woken in order so audit logs keep their order
+        await protocol.drain()
+        if protocol.transport:
+            protocol.transport.write(pkg.to_bytes())
+        else:
+            logging.error('failed to write audit log, connection lost')
+
+    @staticmethod
+    def _pack_batch(pkgs: List[Package]) -> bytes:
+        """Pack packages as [[partid, data], ...]; the package bodies are
+        msgpack data and are included as is (without unpacking)."""
+        packer = msgpack.Packer()
+        parts = [packer.pack_array_header(len(pkgs))]
+        for pkg in pkgs:
+            assert pkg.body is not None
+            parts.append(packer.pack_array_header(2))
+            parts.append(packer.pack(pkg.partid))
+            parts.append(pkg.body)
+        return b''.join(parts)
+
+    def _make_req(self, pkgs: List[Package]) -> Tuple[Package, int]:
+        """Returns a data request and the number of packages (from the start
+        of the given list) which are included in the request."""
+        if len(pkgs) > 1 and self._hub_supports('batch'):
+            tp, n, partid = HubProtocol.PROTO_REQ_DATA_BATCH, len(pkgs), 0
+            data = self._pack_batch(pkgs)
+        else:
+            tp, n, partid = HubProtocol.PROTO_REQ_DATA, 1, pkgs[0].partid
+            data = pkgs[0].body
+        assert data is not None
+
+        name = self._protocol.features.get('codec') \
+            if self._protocol else None
+        if name in codec.CODECS and len(data) >= HUB_COMPRESSION_MIN:
+            compressed = codec.compress(name, tp, data)
+            if len(compressed) < len(data):
+                self._compressed += len(data) - len(compressed)
+                tp, data = HubProtocol.PROTO_REQ_DATA_COMPRESSED, compressed
+
+        req = Package.make(tp, data=data, partid=partid, is_binary=True)
+        return req, n
+
+    async def _ensure_write_req(self, pkgs: List[Package]) -> int:
+        """This will write (the first of) the given packages to the hub.
+        It will try as long as is required and returns the number of packages
+        which are handled.
         """
-        assert self._pkg is not None
+        n = 1
         err_count = 0
         while True:
             if self.is_connected():
                 try:
                     assert self._protocol is not None
-                    await self._protocol.request(self._pkg, timeout=10)
+                    await self._protocol.drain()
+                    if not self.is_connected():
+                        continue
+                    req, n = self._make_req(pkgs)
+                    assert self._protocol is not None
+                    await self._protocol.request(req, timeout=10)
                 except RespException as e:
                     logging.error(f'error from hub: {str(e)}')
                     break
@@ -191,23 +455,143 @@ class Agentcore:
                         break
                 else:
                     logging.debug('successfully send data to hub')
+                    self._drained += n
                     break
             await asyncio.sleep(1)
-        self._pkg = None
+        return n
+
+    async def _ensure_write_pkgs(self, pkgs: List[Package]):
+        while pkgs:
+            n = await self._ensure_write_req(pkgs)
+            for pkg in pkgs[:n]:
+                self.queue.ack(pkg)
+            del pkgs[:n]
+
+    def _on_write_done(self, fut: asyncio.Future):
+        self._in_flight.pop(fut, None)
+        assert self._window is not None
+        self._window.release()
+
+    async def _get_batch(self) -> List[Package]:
+        pkg = await self.queue.get()
+        pkgs = [pkg]
+        if HUB_BATCH_COUNT == 1 or not self._hub_supports('batch'):
+            return pkgs
+
+        size = pkg.length
+        deadline = loop.time() + HUB_BATCH_LINGER
+        while len(pkgs) < HUB_BATCH_COUNT and size < HUB_BATCH_BYTES:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0 or self._draining:
+                    break
+                try:
+                    pkg = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                pkg = self.queue.get_nowait()
+            pkgs.append(pkg)
+            size += pkg.length
+        return pkgs
 
     async def _empty_queue_loop(self):
+        """Sends queued packages to the hub; at most `HUB_WINDOW` requests
+        are outstanding at the same time. Each request is retried on its own
+        until it is acknowledged by the hub."""
+        self._window = asyncio.Semaphore(HUB_WINDOW)
         while True:
-            pkg = await self.queue.get()
+            await self._window.acquire()
+            pkgs = await self._get_batch()
 
-            self._pkg = Package.make(
-                HubProtocol.PROTO_REQ_DATA,
-                data=pkg.body,
-                partid=pkg.partid,
-                is_binary=True
-            )
+            fut = asyncio.ensure_future(self._ensure_write_pkgs(pkgs))
+            self._in_flight[fut] = pkgs
+            fut.add_done_callback(self._on_write_done)
 
-            await self._ensure_write_pkg()
-            await asyncio.sleep(HUB_QUEUE_SLEEP)
+            if not self._draining:
+                await asyncio.sleep(HUB_QUEUE_SLEEP)
+
+    async def drain(self):
+        """Send the queue to the hub at full speed before shutdown; at most
+        `HUB_DRAIN_TIMEOUT` seconds. Probes are paused so no new data is
+        added to the queue."""
+        if HUB_DRAIN_TIMEOUT <= 0 or self._draining:
+            return
+        self._draining = True
+        State.drain_probes()
+
+        def pending() -> int:
+            return self.queue.qsize() + \
+                sum(map(len, self._in_flight.values()))
+
+        queued, drained, t0 = pending(), self._drained, loop.time()
+        logging.warning(
+            f'drain hub queue <queued: {queued} '
+            f'timeout: {HUB_DRAIN_TIMEOUT}s>')
+        deadline = t0 + HUB_DRAIN_TIMEOUT
+        progress, progress_at = self._drained, t0
+        while pending() and loop.time() < deadline:
+            # stop early when nothing can be sent, so the remaining packages
+            # are written to disk before the process gets killed
+            if not self.is_connected():
+                logging.warning('no hub connection; stop draining')
+                break
+            if self._drained != progress:
+                progress, progress_at = self._drained, loop.time()
+            elif loop.time() - progress_at > HUB_DRAIN_STALL:
+                logging.warning(
+                    f'nothing drained for {HUB_DRAIN_STALL}s; '
+                    'stop draining')
+                break
+            await asyncio.sleep(0.1)
+
+        logging.warning(
+            'drained hub queue <'
+            f'drained: {self._drained - drained} '
+            f'remaining: {pending()} '
+            f'time: {loop.time() - t0:.1f}s>')
+
+    def queue_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            'queued': self.queue.qsize(),
+            'bytes': self.queue.nbytes,
+            'in flight': sum(map(len, self._in_flight.values())),
+            'window': HUB_WINDOW,
+            'drained': self._drained,
+            'dropped': self.queue.dropped,
+            'coalesced': self.queue.coalesced,
+            'compressed': self._compressed,
+        }
+        if self._protocol is not None:
+            stats['hub requests'] = self._protocol.in_flight()
+            stats['write buffer'] = self._protocol.write_buffer_size()
+        if isinstance(self.queue, FairQueue) and self.queue.drops:
+            stats['drops'] = dict(self.queue.drops)
+        paused: Dict[str, float] = {
+            conn.probe_key: round(conn.get_paused_time(), 1)
+            for conn in State.probe_connections
+            if conn.probe_key is not None and conn.get_paused_time()}
+        if paused:
+            stats['paused'] = paused
+        return stats
+
+    async def _stats_loop(self):
+        drained, t0 = self._drained, time.time()
+        while True:
+            await asyncio.sleep(HUB_STATS_INTERVAL)
+            t1 = time.time()
+            stats = self.queue_stats()
+            rate = (stats['drained'] - drained) / (t1 - t0)
+            drained, t0 = stats['drained'], t1
+            stats['rate'] = f'{rate:.1f}/s'
+            line = ' '.join(f'{k}: {v}' for k, v in stats.items())
+            if rate or stats['queued']:
+                logging.info(f'hub queue <{line}>')
+            else:
+                logging.debug(f'hub queue <{line}>')
+            line = ' '.join(
+                f'{k}: {v}' for k, v in State.payload_stats().items())
+            logging.debug(f'probe asset payloads <{line}>')
 
     def _read_json(self):
         with open(AGENTCORE_JSON_FN) as fp:
@@ -224,32 +608,90 @@ class Agentcore:
                 '(this might be intentional when using a fixed static file)')
 
     def _read_queue(self):
-        if self._pkg is not None:
-            yield self._pkg.to_bytes()
+        for pkgs in self._in_flight.values():
+            yield from pkgs
         try:
             while True:
-                pkg = self.queue.get_nowait()
-                yield pkg.to_bytes()
+                yield self.queue.get_nowait()
         except asyncio.QueueEmpty:
             pass
 
     def dump_queue(self):
+        if isinstance(self.queue, SpoolQueue):
+            # packages are already on disk, including those in flight
+            self.queue.close()
+            return
         logging.info(f'write queue to: {AGENTCORE_QUEUE_FN}')
-        with open(AGENTCORE_QUEUE_FN, 'wb') as fp:
-            msgpack.pack([pkg for pkg in self._read_queue()], fp)
+        # packages are written one by one (header and body) so no copy of
+        # the queue is made; when killed during the write, the packages
+        # written so far can still be read
+        n = skipped = 0
+        with open(AGENTCORE_QUEUE_FN, 'wb', buffering=1 << 20) as fp:
+            fp.write(QUEUE_MAGIC)
+            for pkg in self._read_queue():
+                if pkg.body is None:
+                    # without a body the package cannot be sent anyway
+                    skipped += 1
+                    continue
+                fp.write(pkg.header())
+                fp.write(pkg.body)
+                n += 1
+        if skipped:
+            logging.warning(f'skipped {skipped} package(s) without data')
+        logging.info(f'written {n} package(s) to queue file')
+
+    def _load_queue_legacy(self, fp) -> int:
+        data: Tuple[bytearray] = msgpack.unpack(
+            fp, use_list=False, strict_map_key=False)  # type: ignore
+        n = 0
+        for barray in data:
+            pkg = Package.from_bytes(barray)
+            if not self.queue.fits(pkg):
+                logging.warning(
+                    f'hub queue full; skip {len(data) - n} package(s)')
+                break
+            self.queue.put_nowait(pkg)
+            n += 1
+        return n
+
+    def _load_queue_stream(self, fp) -> int:
+        header_size = Package.st_package.size
+        n = 0
+        while True:
+            barray = bytearray(fp.read(header_size))
+            if not barray:
+                break
+            if len(barray) < header_size:
+                logging.warning('queue file ends with an incomplete package')
+                break
+            pkg = Package(barray)
+            body = fp.read(pkg.length)
+            if len(body) < pkg.length:
+                logging.warning('queue file ends with an incomplete package')
+                break
+            pkg.body = body
+            if not self.queue.fits(pkg):
+                skip = os.fstat(fp.fileno()).st_size - fp.tell() + pkg.total
+                logging.warning(
+                    f'hub queue full; skip remaining {skip} bytes')
+                break
+            self.queue.put_nowait(pkg)
+            n += 1
+        return n
 
     def load_queue(self):
         if not os.path.exists(AGENTCORE_QUEUE_FN):
             logging.info('no queue file')
             return
         try:
-            with open(AGENTCORE_QUEUE_FN, 'rb') as fp:
-                data: Tuple[bytearray] = msgpack.unpack(
-                    fp, use_list=False, strict_map_key=False)  # type: ignore
-            for barray in data[:HUB_QUEUE_SIZE]:
-                pkg = Package.from_bytes(barray)
-                self.queue.put_nowait(pkg)
-            logging.info(f'read {len(data)} package(s) for queue at startup')
+            with open(AGENTCORE_QUEUE_FN, 'rb', buffering=1 << 20) as fp:
+                if fp.read(len(QUEUE_MAGIC)) == QUEUE_MAGIC:
+                    n = self._load_queue_stream(fp)
+                else:
+                    # queue file written by an older version
+                    fp.seek(0)
+                    n = self._load_queue_legacy(fp)
+            logging.info(f'read {n} package(s) for queue at startup')
         except Exception as e:
             msg = str(e) or type(e).__name__
             logging.error(
@@ -265,7 +707,10 @@ class Agentcore:
 
     def close_protocol(self):
         if self._protocol and self._protocol.transport:
+            self._protocol.closed_locally = True
             self._protocol.transport.close()
+            # the transport may still be flushing; do not let producers wait
+            self._protocol.resume_writing()
         self._protocol = None
 
     def close(self):
@@ -273,6 +718,12 @@ class Agentcore:
             self._queue_fut.cancel()
         if self._connect_fut is not None:
             self._connect_fut.cancel()
+        if self._stats_fut is not None:
+            self._stats_fut.cancel()
+        if self._snapshot_fut is not None:
+            self._snapshot_fut.cancel()
+        for fut in self._in_flight:
+            fut.cancel()
         self.close_protocol()
         try:
             self.dump_queue()
@@ -0,0 +1,40 @@
+import zlib
+from typing import Callable, Dict, List, Tuple, Union
+
+try:
+    from compression import zstd  # type: ignore  # Python 3.14+
+except ImportError:
+    zstd = None
+
+try:
+    import lz4.frame as lz4  # type: ignore
+except ImportError:
+    lz4 = None
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# name: (codec id, compress function); the codec id is written in front of
+# compressed data so the receiver knows how to decompress
+CODECS: Dict[str, Tuple[int, Callable[[Buffer], bytes]]] = {
+    'zlib': (1, zlib.compress),
+}
+if lz4 is not None:
+    CODECS['lz4'] = (2, lz4.compress)
+if zstd is not None:
+    CODECS['zstd'] = (3, zstd.compress)
+
+
+def available(preferred: str = 'auto') -> List[str]:
+    """Returns the available codecs, in order of preference."""
+    if preferred == 'auto':
+        return [name for name in ('zstd', 'lz4', 'zlib') if name in CODECS]
+    if preferred in CODECS:
+        return [preferred]
+    return []
+
+
+def compress(name: str, tp: int, data: Buffer) -> bytes:
+    """Returns the compressed data, prefixed with the codec id and the
+    package type of the uncompressed data."""
+    codec_id, func = CODECS[name]
+    return bytes((codec_id, tp)) + func(data)
@@ -39,9 +39,12 @@ class ProbeServerProtocol(Protocol):
         super().__init__()
         self.probe_key: Optional[str] = None
         self.version: Optional[str] = None
+        self.paused_time = 0.0  # total seconds reading was paused
+        self._paused_at: Optional[float] = None
 
     def connection_lost(self, exc: Optional[Exception]):
         logging.info(f'Connection lost; probe collector: `{self.probe_key}`')
+        self.resume()
         super().connection_lost(exc)
         try:
             State.probe_connections.remove(self)
@@ -65,36 +68,69 @@ class ProbeServerProtocol(Protocol):
             'roundtrip': time.time() - t0,
         }
 
-    def send_unset_assets(self, asset_ids: list):
+    def pause(self):
+        """Stop reading from the probe collector; this results in TCP
+        backpressure so the collector buffers (or slows down) its data."""
+        if self.transport is None or self._paused_at is not None:
+            return
+        self.transport.pause_reading()
+        self._paused_at = time.time()
+
+    def resume(self):
+        if self._paused_at is None:
+            return
+        self.paused_time += time.time() - self._paused_at
+        self._paused_at = None
+        if self.transport is not None:
+            self.transport.resume_reading()
+
+    def get_paused_time(self) -> float:
+        if self._paused_at is None:
+            return self.paused_time
+        return self.paused_time + time.time() - self._paused_at
+
+    def send_unset_assets(self, payload: bytes):
+        """Remove assets; the payload are the msgpack encoded asset Ids."""
         assert self.transport is not None
         resp_pkg = Package.make(
-            ProbeServerProtocol.PROTO_FAF_UNSET_ASSETS, data=asset_ids)
-        self.transport.write(resp_pkg.to_bytes())
-
-    def send_upsert_asset(self, asset: list):
+            ProbeServerProtocol.PROTO_FAF_UNSET_ASSETS,
+            data=payload,
+            is_binary=True)
+        resp_pkg.write_to(self.transport)
+
+    def send_upsert_asset(self, payload: bytes):
+        """Overwrite a single asset; the payload is the msgpack encoded
+        asset Id and checks."""
         assert self.transport is not None
         resp_pkg = Package.make(
-            ProbeServerProtocol.PROTO_FAF_UPSERT_ASSET, data=asset)
-        self.transport.write(resp_pkg.to_bytes())
+            ProbeServerProtocol.PROTO_FAF_UPSERT_ASSET,
+            data=payload,
+            is_binary=True)
+        resp_pkg.write_to(self.transport)
 
-    def send_set_assets(self, assets: list):
+    def send_set_assets(self, payload: bytes):
+        """Send all checks; the payload are the msgpack encoded checks."""
         assert self.transport is not None
         resp_pkg = Package.make(
-            ProbeServerProtocol.PROTO_FAF_SET_ASSETS, data=assets)
-        self.transport.write(resp_pkg.to_bytes())
+            ProbeServerProtocol.PROTO_FAF_SET_ASSETS,
+            data=payload,
+            is_binary=True)
+        resp_pkg.write_to(self.transport)
 
     def _on_faf_dump(self, pkg):
         assert State.agentcore is not None
-        try:
-            State.agentcore.queue.put_nowait(pkg)
-        except asyncio.QueueFull:
+        queue = State.agentcore.queue
+        if not queue.fits(pkg):
             logging.warning('hub queue full; drop first in queue')
-            try:
-                State.agentcore.queue.get_nowait()
-                State.agentcore.queue.put_nowait(pkg)
-            except Exception as e:
-                msg = str(e) or type(e).__name__
-                logging.error(f'failed to add package to hub queue: {msg}')
+        try:
+            # the queue is bounded by bytes so one large package might
+            # require more than one package to be dropped
+            while not queue.fits(pkg) and not queue.empty():
+                queue.drop()
+            queue.put_nowait(pkg, self.probe_key or '')
+        except Exception as e:
+            msg = str(e) or type(e).__name__
+            logging.error(f'failed to add package to hub queue: {msg}')
 
     def _on_req_announce(self, pkg: Package):
         assert self.transport is not None
@@ -113,19 +149,18 @@ class ProbeServerProtocol(Protocol):
                         'got a double probe collector announcement: '
                         f'{name} v{conn.version}; close the connection')
 
-            assets = State.probe_assets.get(name)
-            if assets is None:
+            if name not in State.probe_assets:
                 logging.warning(
                     f'no assets found for probe collector: {name}')
-                assets = []
 
             resp_pkg = Package.make(
                 ProbeServerProtocol.PROTO_RES_ANNOUNCE,
                 pid=pkg.pid,
-                data=assets)
+                data=State.probe_payload(name),
+                is_binary=True)
 
             try:
-                self.transport.write(resp_pkg.to_bytes())
+                resp_pkg.write_to(self.transport)
             except Exception as e:
                 msg = str(e) or type(e).__name__
                 raise Exception(f'failed to write announce response: {msg}')
@@ -133,6 +168,8 @@ class ProbeServerProtocol(Protocol):
             self.probe_key = name
             self.version = version
             State.probe_connections.add(self)
+            if State.probes_paused:
+                self.pause()
 
         except Exception as e:
             logging.error(f'{e}; close the connection')
@@ -172,8 +209,9 @@ class ProbeServerProtocol(Protocol):
                 data=resp,
                 pid=pkg.pid)
 
+        await self.drain()
         if self.transport:
-            self.transport.write(resp_pkg.to_bytes())
+            resp_pkg.write_to(self.transport)
 
     def _on_download_file(self, pkg: Package):
         asyncio.ensure_future(self._download_file(pkg))
@@ -194,8 +232,9 @@ class ProbeServerProtocol(Protocol):
                 data=resp,
                 pid=pkg.pid)
 
+        await self.drain()
         if self.transport:
-            self.transport.write(resp_pkg.to_bytes())
+            resp_pkg.write_to(self.transport)
 
     def on_package_received(self, pkg: Package, _map={
         PROTO_FAF_DUMP: _on_faf_dump,
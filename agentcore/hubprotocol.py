@@ -1,13 +1,41 @@
 import asyncio
 import logging
+import os
+import socket
 import time
-from typing import Optional
+from typing import Optional, Union
 from .net.package import Package
 from .net.protocol import Protocol
 from .connection.rappprotocol import RappProtocol
 from .state import State
 from .version import __version__
 
+# the connection is closed when a request is not answered within
+# `HUB_KEEPALIVE_TIMEOUT` seconds; with `HUB_KEEPALIVE_PING` enabled, the hub
+# is pinged (if supported by the hub) when nothing is received for
+# `HUB_KEEPALIVE_INTERVAL` seconds; the ping feature changes the announce so
+# it is disabled by default
+HUB_KEEPALIVE_INTERVAL = float(os.getenv('HUB_KEEPALIVE_INTERVAL', 5))
+HUB_KEEPALIVE_TIMEOUT = float(os.getenv('HUB_KEEPALIVE_TIMEOUT', 10))
+HUB_KEEPALIVE_PING = int(os.getenv('HUB_KEEPALIVE_PING', 0))
+
+# idle time in seconds before TCP keepalive probes are sent; 0 disables
+HUB_TCP_KEEPALIVE = int(os.getenv('HUB_TCP_KEEPALIVE', 0))
+
+
+def set_tcp_keepalive(sock: socket.socket, idle: int):
+    """Enable TCP keepalive; a dead peer is detected after about twice the
+    idle time."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    interval = max(idle // 3, 1)
+    # not all platforms support setting the timings
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
 
 class RespException(Exception):
     pass
@@ -33,6 +61,13 @@ class HubProtocol(Protocol):
 
     PROTO_REQ_DOWNLOAD_FILE = 0x8
 
+    PROTO_REQ_DATA_BATCH = 0x9  # [[partid, data], ...] (feature: batch)
+
+    # <codec id><package type><compressed body> (feature: codecs)
+    PROTO_REQ_DATA_COMPRESSED = 0xa
+
+    PROTO_REQ_PING = 0xb  # None (feature: ping)
+
     PROTO_FAF_AUDIT_LOG = 0x60  # {"event_id": 123, "message": "..."}
 
     PROTO_RES_ANNOUNCE = 0x81
@@ -51,22 +86,118 @@ class HubProtocol(Protocol):
 
     def __init__(self):
         super().__init__()
+        self.features: dict = {}  # accepted by the hub on announce
+        self.keepalive: Optional[asyncio.Future] = None
+        # set when the agentcore closes the connection, for example because
+        # the hub does not respond
+        self.closed_locally = False
+        self._last_rx = time.monotonic()
+        # time of the first request sent after the last received data
+        self._waiting_since: Optional[float] = None
+
+    def connection_made(self, transport: asyncio.Transport):  # type: ignore
+        super().connection_made(transport)
+        self._last_rx = time.monotonic()
+        if HUB_TCP_KEEPALIVE > 0:
+            sock = transport.get_extra_info('socket')
+            try:
+                set_tcp_keepalive(sock, HUB_TCP_KEEPALIVE)
+            except Exception as e:
+                msg = str(e) or type(e).__name__
+                logging.warning(f'failed to set TCP keepalive: {msg}')
+        if HUB_KEEPALIVE_INTERVAL > 0:
+            self.keepalive = asyncio.ensure_future(self.keepalive_loop())
 
     def connection_lost(self, exc: Optional[Exception]):
         super().connection_lost(exc)
+        if self.keepalive is not None:
+            self.keepalive.cancel()
+            self.keepalive = None
+        if State.agentcore is not None:
+            State.agentcore.on_connection_lost(exc, self.closed_locally)
+
+    def data_received(self, data: bytes):
+        # any data from the hub proves the connection is alive
+        self._last_rx = time.monotonic()
+        self._waiting_since = None
+        super().data_received(data)
+
+    async def keepalive_loop(self):
+        """Detects a dead (half-open) connection. Received data counts as a
+        sign of life so the hub is only pinged when the connection is idle.
+        The connection is closed when nothing is received for
+        `HUB_KEEPALIVE_TIMEOUT` seconds while a ping or request is waiting;
+        for a request on an idle connection, the silence is counted from the
+        moment it was sent, also when the request itself has timed out.
+        Older hubs cannot be pinged; those connections are only closed when
+        a request is waiting for a response."""
+        # check on a finer tick than the interval so the close happens close
+        # to the timeout instead of up to an interval later
+        tick = min(HUB_KEEPALIVE_INTERVAL, HUB_KEEPALIVE_TIMEOUT) / 4
+        ping: Optional[asyncio.Future] = None
+        while True:
+            await asyncio.sleep(tick)
+            if self.transport is None:
+                return
+            now = time.monotonic()
+            idle = now - self._last_rx
+            if idle < HUB_KEEPALIVE_INTERVAL:
+                continue
+
+            can_ping = bool(self.features.get('ping'))
+            if can_ping and (ping is None or ping.done()):
+                ping = asyncio.ensure_future(self._ping())
+            # a request which timed out still counts as waiting
+            if self._waiting_since is None:
+                continue
+
+            # with pings the hub is watched while idle, so the silence
+            # counts from the last received data
+            since = self._last_rx if can_ping else \
+                max(self._last_rx, self._waiting_since)
+            silent = now - since
+            if silent >= HUB_KEEPALIVE_TIMEOUT:
+                logging.error(
+                    f'no response from hub for {silent:.1f}s; '
+                    'close the connection')
+                # abort; closing would wait for the write buffer to flush
+                self.closed_locally = True
+                self.transport.abort()
+                return
+
+    def request(
+        self,
+        pkg: Package,
+        timeout: Union[None, float, int] = None
+    ) -> asyncio.Future:
+        if self._waiting_since is None:
+            self._waiting_since = time.monotonic()
+        return super().request(pkg, timeout)
+
+    async def _ping(self):
+        pkg = Package.make(self.PROTO_REQ_PING, is_binary=True)
+        try:
+            await self.request(pkg, timeout=HUB_KEEPALIVE_TIMEOUT)
+            logging.debug('hub keep-alive')
+        except Exception as e:
+            msg = str(e) or type(e).__name__
+            logging.debug(f'hub keep-alive failed: {msg}')
 
     def _on_res_announce(self, pkg: Package):
         try:
-            agentcore_id, agentcores, assets = pkg.read_data()
+            agentcore_id, agentcores, assets, *extra = pkg.read_data()
         except Exception as e:
             msg = str(e) or type(e).__name__
             logging.error(f'ac announce failed: {msg}')
             return
+        # older hubs do not respond with features
+        self.features = extra[0] if extra and extra[0] else {}
         logging.info(
             'ac announce <'
             f'agentcore_id: {agentcore_id} '
             f'num assets: {len(assets)} '
-            f'num agentcores: {len(agentcores)}>')
+            f'num agentcores: {len(agentcores)} '
+            f'features: {", ".join(self.features) or "none"}>')
         State.agentcore_id = agentcore_id
         State.set_zones(agentcores)
         State.set_assets(assets)
@@ -138,6 +269,7 @@ class HubProtocol(Protocol):
                 'version': __version__
             }
         )
+        await self.drain()
         assert self.transport is not None
         self.transport.write(resp_pkg.to_bytes())
 
@@ -163,8 +295,9 @@ class HubProtocol(Protocol):
                 pid=pkg.pid)
 
         # write response
+        await self.drain()
         assert self.transport is not None
-        self.transport.write(pkg.to_bytes())
+        pkg.write_to(self.transport)
 
     def _on_res_err(self, pkg: Package):
         future = self._get_future(pkg)
@@ -0,0 +1,545 @@
+import asyncio
+import logging
+import msgpack
+import os
+from collections import deque, defaultdict, OrderedDict
+from typing import Optional, Deque, Dict, Tuple, List, Callable
+from .loop import loop
+from .net.package import Package
+
+
+class HubQueue:
+    """In-memory FIFO queue with packages which are waiting to be sent to
+    the hub. The interface is compatible with `asyncio.Queue` with the
+    addition of `ack()`, `drop()` and `close()`.
+
+    The queue is bounded by both the number of packages (maxsize) and the
+    total size of the package bodies in bytes (max_bytes); 0 is unbounded.
+
+    When coalesce is set to N > 0, only the newest N dumps for each check are
+    kept; older dumps for the same check are removed from the queue.
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 0,
+            max_bytes: int = 0,
+            coalesce: int = 0):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.coalesce = coalesce
+        self._nbytes = 0
+        # ordered dict instead of a deque so superseded packages can be
+        # removed in O(1)
+        self._queue: OrderedDict[Package, None] = OrderedDict()
+        self._not_empty = asyncio.Event()
+        self.dropped = 0
+        self.coalesced = 0
+        self._keys: Dict[Package, tuple] = {}
+        self._latest: Dict[tuple, Deque[Package]] = {}
+        self._high = 0.0
+        self._low = 0.0
+        self._on_high: Optional[Callable[[], None]] = None
+        self._on_low: Optional[Callable[[], None]] = None
+        self._above = False
+
+    def qsize(self) -> int:
+        return self._qsize()
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.qsize() or \
+            0 < self.max_bytes <= self.nbytes
+
+    def usage(self) -> float:
+        """Returns the usage of the queue as a fraction of its limits."""
+        usage = 0.0
+        if self.maxsize > 0:
+            usage = self.qsize() / self.maxsize
+        if self.max_bytes > 0:
+            usage = max(usage, self.nbytes / self.max_bytes)
+        return usage
+
+    def set_watermarks(
+            self,
+            high: float,
+            low: float,
+            on_high: Callable[[], None],
+            on_low: Callable[[], None]):
+        """The on_high callback is called when the usage of the queue reaches
+        the high watermark; on_low is called when the usage is back at, or
+        below the low watermark."""
+        self._high = high
+        self._low = low
+        self._on_high = on_high
+        self._on_low = on_low
+
+    def fits(self, pkg: Package) -> bool:
+        """Returns True when the package can be added without exceeding the
+        limits of the queue."""
+        return not (
+            0 < self.maxsize <= self.qsize() or
+            0 < self.max_bytes < self.nbytes + self._sizeof(pkg))
+
+    def put_nowait(self, pkg: Package, key: str = ''):
+        """Add a package to the queue; the key is the probe key of the
+        package, or an empty string when unknown."""
+        if self.full():
+            raise asyncio.QueueFull
+        self._put(pkg, key)
+        if self.coalesce:
+            self._coalesce(pkg, key)
+        self._not_empty.set()
+        self._watermarks()
+
+    def get_nowait(self) -> Package:
+        if self.empty():
+            raise asyncio.QueueEmpty
+        pkg = self._next()
+        self._watermarks()
+        return pkg
+
+    async def get(self) -> Package:
+        while self.empty():
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        pkg = self._next()
+        self._watermarks()
+        return pkg
+
+    def ack(self, pkg: Package):
+        """Must be called when a package (returned by get) is handled."""
+        pass
+
+    def drop(self) -> Package:
+        """Remove and acknowledge the oldest package in the queue."""
+        pkg = self.get_nowait()
+        self.ack(pkg)
+        self.dropped += 1
+        return pkg
+
+    def close(self):
+        pass
+
+    def _watermarks(self):
+        if self._on_high is None or self._on_low is None:
+            return
+        if self._above:
+            if self.usage() <= self._low:
+                self._above = False
+                self._on_low()
+        elif self.usage() >= self._high:
+            self._above = True
+            self._on_high()
+
+    @staticmethod
+    def _dump_path(pkg: Package) -> Optional[tuple]:
+        """Returns the (asset_id, check_id) path of a probe dump without
+        unpacking the complete body; a dump is packed as [path, check_data].
+        """
+        if not pkg.body:
+            return None
+        unpacker = msgpack.Unpacker(use_list=False)
+        unpacker.feed(pkg.body[:64])
+        try:
+            unpacker.read_array_header()
+            path = unpacker.unpack()
+        except Exception:
+            return None
+        if isinstance(path, tuple) and len(path) == 2:
+            return path
+        return None
+
+    def _coalesce(self, pkg: Package, key: str):
+        path = self._dump_path(pkg)
+        if path is None:
+            return
+        ckey = (key, path)
+        self._keys[pkg] = ckey
+        latest = self._latest.get(ckey)
+        if latest is None:
+            latest = self._latest[ckey] = deque()
+        latest.append(pkg)
+        if len(latest) > self.coalesce:
+            old = latest.popleft()
+            del self._keys[old]
+            self._remove(old, key)
+            self.coalesced += 1
+
+    def _untrack(self, pkg: Package):
+        ckey = self._keys.pop(pkg, None)
+        if ckey is None:
+            return
+        latest = self._latest[ckey]
+        latest.remove(pkg)
+        if not latest:
+            del self._latest[ckey]
+
+    def _next(self) -> Package:
+        pkg = self._get()
+        self._untrack(pkg)
+        return pkg
+
+    def _sizeof(self, pkg: Package) -> int:
+        return pkg.length
+
+    def _qsize(self) -> int:
+        return len(self._queue)
+
+    def _put(self, pkg: Package, key: str):
+        self._queue[pkg] = None
+        self._nbytes += pkg.length
+
+    def _get(self) -> Package:
+        pkg, _ = self._queue.popitem(last=False)
+        self._nbytes -= pkg.length
+        return pkg
+
+    def _remove(self, pkg: Package, key: str):
+        del self._queue[pkg]
+        self._nbytes -= pkg.length
+
+
+class FairQueue(HubQueue):
+    """In-memory queue with a sub-queue for each probe. The sub-queues are
+    served using deficit round robin (in bytes) so a probe with a lot of data
+    cannot delay the data of other probes. When packages must be dropped,
+    they are taken from the probe with the most queued bytes relative to its
+    weight.
+    """
+
+    QUANTUM = 1 << 16  # bytes per round for a probe with weight 1
+
+    def __init__(
+            self,
+            maxsize: int = 0,
+            max_bytes: int = 0,
+            coalesce: int = 0,
+            weights: Optional[Dict[str, int]] = None):
+        super().__init__(
+            maxsize=maxsize,
+            max_bytes=max_bytes,
+            coalesce=coalesce)
+        self.weights = weights or {}
+        self.drops: Dict[str, int] = defaultdict(int)
+        self._queues: Dict[str, OrderedDict[Package, None]] = {}
+        self._key_nbytes: Dict[str, int] = {}
+        self._deficit: Dict[str, int] = {}
+        self._active: Deque[str] = deque()  # round robin order
+        self._count = 0
+
+    def drop(self) -> Package:
+        if self.empty():
+            raise asyncio.QueueEmpty
+        key = max(
+            self._queues,
+            key=lambda k: self._key_nbytes[k] / self._weight(k))
+        pkg = self._pop(key)
+        self._untrack(pkg)
+        self.drops[key] += 1
+        self.dropped += 1
+        self._watermarks()
+        return pkg
+
+    def _weight(self, key: str) -> int:
+        return self.weights.get(key, 1)
+
+    def _qsize(self) -> int:
+        return self._count
+
+    def _put(self, pkg: Package, key: str):
+        q = self._queues.get(key)
+        if q is None:
+            q = self._queues[key] = OrderedDict()
+            self._key_nbytes[key] = 0
+            self._deficit[key] = 0
+            self._active.append(key)
+        q[pkg] = None
+        self._key_nbytes[key] += pkg.length
+        self._nbytes += pkg.length
+        self._count += 1
+
+    def _pop(self, key: str) -> Package:
+        pkg, _ = self._queues[key].popitem(last=False)
+        self._discard(pkg, key)
+        return pkg
+
+    def _remove(self, pkg: Package, key: str):
+        del self._queues[key][pkg]
+        self._discard(pkg, key)
+
+    def _discard(self, pkg: Package, key: str):
+        self._key_nbytes[key] -= pkg.length
+        self._nbytes -= pkg.length
+        self._count -= 1
+        if not self._queues[key]:
+            del self._queues[key]
+            del self._key_nbytes[key]
+            del self._deficit[key]
+            self._active.remove(key)
+
+    def _get(self) -> Package:
+        while True:
+            key = self._active[0]
+            size = next(iter(self._queues[key])).length
+            if self._deficit[key] >= size:
+                self._deficit[key] -= size
+                return self._pop(key)
+            # not enough credit left; continue with the next probe
+            self._active.rotate(-1)
+            key = self._active[0]
+            self._deficit[key] += self.QUANTUM * self._weight(key)
+
+
+class _Segment:
+
+    __slots__ = ('seq', 'fn', 'size', 'count', 'acked')
+
+    def __init__(self, seq: int, fn: str):
+        self.seq = seq
+        self.fn = fn
+        self.size = 0  # bytes written to the file
+        self.count = 0  # number of records written to the file
+        self.acked = 0  # number of records acknowledged
+
+
+class SpoolQueue(HubQueue):
+    """Disk backed queue. Packages are appended to segment files in the
+    spool path and are only removed from disk when all packages in a segment
+    are acknowledged. Unacknowledged packages survive a crash and are sent
+    again after a restart (at-least-once delivery).
+    """
+
+    EXT = '.spool'
+
+    def __init__(
+            self,
+            path: str,
+            max_bytes: int,
+            segment_size: int,
+            fsync_interval: float):
+        super().__init__(max_bytes=max_bytes)
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+
+        self._segments: Deque[_Segment] = deque()
+        self._unacked: Dict[Package, Tuple[_Segment, int]] = {}
+        self._count = 0  # number of unread packages
+        # self._nbytes are the bytes of packages which are not acknowledged
+        self._rseg: Optional[_Segment] = None
+        self._rseq = -1
+        self._rfp = None
+        self._roff = 0
+        self._wfp = None
+        self._wseq = 0
+        self._sync_handle: Optional[asyncio.TimerHandle] = None
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._resume()
+        self._rotate()
+
+    def _qsize(self) -> int:
+        return self._count
+
+    def ack(self, pkg: Package):
+        try:
+            seg, size = self._unacked.pop(pkg)
+        except KeyError:
+            return
+        seg.acked += 1
+        self._nbytes -= size
+        if seg.acked == seg.count and seg is not self._segments[-1]:
+            self._remove_segment(seg)
+        self._watermarks()
+
+    def close(self):
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        if self._rfp is not None:
+            self._rfp.close()
+            self._rfp = None
+        if self._wfp is not None:
+            # on shutdown, sync at once; the loop might not run anymore
+            os.fsync(self._wfp.fileno())
+            self._wfp.close()
+            self._wfp = None
+            seg = self._segments[-1]
+            if seg.count == 0:
+                self._remove_segment(seg)
+        logging.info(
+            f'closed spool <path: {self.path} unread: {self._count} '
+            f'bytes: {self._nbytes}>')
+
+    def _sizeof(self, pkg: Package) -> int:
+        return Package.st_package.size + pkg.length
+
+    def _fn(self, seq: int) -> str:
+        return os.path.join(self.path, f'{seq:016d}{self.EXT}')
+
+    def _scan(self, seg: _Segment):
+        """Count the records in a segment file; a damaged or incomplete tail
+        (for example after a crash) is truncated."""
+        header_size = Package.st_package.size
+        file_size = os.path.getsize(seg.fn)
+        with open(seg.fn, 'rb') as fp:
+            while seg.size < file_size:
+                header = fp.read(header_size)
+                try:
+                    total = Package(bytearray(header)).total
+                except Exception:
+                    total = file_size + 1  # invalid; forces truncate
+                if seg.size + total > file_size:
+                    logging.warning(
+                        f'truncate damaged spool segment: {seg.fn} '
+                        f'({file_size - seg.size} bytes)')
+                    os.truncate(seg.fn, seg.size)
+                    break
+                fp.seek(total - header_size, os.SEEK_CUR)
+                seg.size += total
+                seg.count += 1
+
+    def _resume(self):
+        seqs: List[int] = sorted(
+            int(fn[:-len(self.EXT)])
+            for fn in os.listdir(self.path)
+            if fn.endswith(self.EXT) and fn[:-len(self.EXT)].isdigit())
+
+        for seq in seqs:
+            seg = _Segment(seq, self._fn(seq))
+            self._wseq = seq + 1
+            self._scan(seg)
+            if seg.count == 0:
+                self._remove_segment(seg)
+                continue
+            self._segments.append(seg)
+            self._count += seg.count
+            self._nbytes += seg.size
+
+        if self._segments:
+            logging.info(
+                f'resume spool <path: {self.path} '
+                f'segments: {len(self._segments)} '
+                f'packages: {self._count} bytes: {self._nbytes}>')
+
+    def _rotate(self):
+        if self._wfp is not None:
+            self._sync()
+            self._wfp.close()
+            prev = self._segments[-1]
+            if prev.acked == prev.count:
+                self._remove_segment(prev)
+
+        seq = self._wseq
+        self._wseq += 1
+        seg = _Segment(seq, self._fn(seq))
+        # unbuffered; each package is handed to the OS at once so a crash of
+        # the process does not lose data; the write only copies to the page
+        # cache, waiting for the disk is left to the fsync which is done in
+        # batches and in a thread
+        self._wfp = open(seg.fn, 'ab', buffering=0)
+        self._segments.append(seg)
+
+    def _remove_segment(self, seg: _Segment):
+        if seg is self._rseg:
+            if self._rfp is not None:
+                self._rfp.close()
+                self._rfp = None
+            self._rseg = None
+        try:
+            self._segments.remove(seg)
+        except ValueError:
+            pass
+        try:
+            os.remove(seg.fn)
+        except Exception as e:
+            msg = str(e) or type(e).__name__
+            logging.error(f'failed to remove: {seg.fn} ({msg})')
+
+    def _sync(self):
+        """Flush the segment which is written to disk; the fsync runs in a
+        thread so a slow disk does not stall the event loop."""
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        if self._wfp is not None:
+            # a duplicate stays valid when the segment is closed in the
+            # meantime
+            fd = os.dup(self._wfp.fileno())
+            asyncio.ensure_future(self._fsync(fd))
+
+    @staticmethod
+    async def _fsync(fd: int):
+        try:
+            await loop.run_in_executor(None, os.fsync, fd)
+        except Exception as e:
+            msg = str(e) or type(e).__name__
+            logging.error(f'failed to sync spool: {msg}')
+        finally:
+            os.close(fd)
+
+    def _put(self, pkg: Package, key: str):
+        seg = self._segments[-1]
+        if seg.size >= self.segment_size:
+            self._rotate()
+            seg = self._segments[-1]
+
+        assert self._wfp is not None
+        data = memoryview(pkg.to_bytes())
+        try:
+            n = 0
+            while n < len(data):
+                n += self._wfp.write(data[n:])
+        except Exception:
+            # never leave an incomplete record behind
+            os.truncate(seg.fn, seg.size)
+            raise
+
+        seg.size += len(data)
+        seg.count += 1
+        self._count += 1
+        self._nbytes += len(data)
+
+        if self._sync_handle is None:
+            self._sync_handle = \
+                loop.call_later(self.fsync_interval, self._sync)
+
+    def _open_next(self):
+        if self._rfp is not None:
+            self._rfp.close()
+            self._rfp = None
+        for seg in self._segments:
+            if seg.seq > self._rseq:
+                break
+        else:
+            raise asyncio.QueueEmpty
+        self._rfp = open(seg.fn, 'rb')
+        self._rseg = seg
+        self._rseq = seg.seq
+        self._roff = 0
+
+    def _get(self) -> Package:
+        while self._rseg is None or self._roff >= self._rseg.size:
+            # the current segment is completely read (or no segment is open
+            # for reading yet); continue with the next segment
+            self._open_next()
+
+        assert self._rfp is not None
+        header_size = Package.st_package.size
+        barray = bytearray(self._rfp.read(header_size))
+        pkg = Package(barray)
+        barray.extend(self._rfp.read(pkg.length))
+        pkg.body = barray[header_size:pkg.total]
+        self._roff += pkg.total
+
+        self._count -= 1
+        self._unacked[pkg] = (self._rseg, pkg.total)
+        return pkg
@@ -1,8 +1,11 @@
 from __future__ import annotations
+import asyncio
 import logging
 import msgpack
 import struct
-from typing import Optional, Any
+from typing import Optional, Union, Any
+
+Buffer = Union[bytes, bytearray, memoryview]
 
 
 class Package(object):
@@ -11,16 +14,22 @@ class Package(object):
 
     st_package = struct.Struct('<QIHBB')
 
-    def __init__(self, barray: Optional[bytearray] = None):
+    # bodies of at least this size are not copied when possible
+    ZERO_COPY_SIZE = 1 << 16
+
+    def __init__(
+            self,
+            barray: Optional[Buffer] = None,
+            offset: int = 0):
         if barray is None:
             return
 
         self.partid, self.length, self.pid, self.tp, checkbit = \
-            self.__class__.st_package.unpack_from(barray, offset=0)
+            self.__class__.st_package.unpack_from(barray, offset=offset)
         if self.tp != checkbit ^ 255:
             raise ValueError('invalid checkbit')
         self.total = self.__class__.st_package.size + self.length
-        self.body: Optional[bytearray] = None
+        self.body: Optional[Buffer] = None
         self.data: Any = None
 
     @classmethod
@@ -44,16 +53,26 @@ class Package(object):
         pkg.length = len(data)
         return pkg
 
-    def to_bytes(self) -> bytes:
-        header = self.st_package.pack(
+    def header(self) -> bytes:
+        return self.st_package.pack(
             self.partid,
             self.length,
             self.pid,
             self.tp,
             self.tp ^ 0xff)
 
+    def to_bytes(self) -> bytes:
+        assert self.body is not None
+        return self.header() + self.body
+
+    def write_to(self, transport: asyncio.WriteTransport):
+        """Write the package to a transport; large bodies are written
+        without joining them with the header."""
         assert self.body is not None
-        return header + self.body
+        if self.length < self.ZERO_COPY_SIZE:
+            transport.write(self.to_bytes())
+        else:
+            transport.writelines((self.header(), self.body))
 
     @classmethod
     def from_bytes(cls, barray: bytearray) -> Package:
@@ -61,13 +80,22 @@ class Package(object):
         pkg.body = barray[cls.st_package.size:pkg.total]
         return pkg
 
-    def extract_data_from(self, barray: bytearray):
+    def extract_data_from(self, barray: Buffer, offset: int):
+        """Read the body for this package from the given buffer; the package
+        starts at the given offset. The caller is responsible for removing
+        the data from the buffer.
+
+        When reading from a memoryview, a large body remains a view on the
+        same memory; a small body is copied so it does not keep the complete
+        buffer alive."""
         self.body = None
-        try:
-            if self.length:
-                self.body = barray[self.__class__.st_package.size:self.total]
-        finally:
-            del barray[:self.total]
+        if self.length:
+            start = offset + self.__class__.st_package.size
+            body = barray[start:offset + self.total]
+            if isinstance(body, memoryview) and \
+                    self.length < self.ZERO_COPY_SIZE:
+                body = bytes(body)
+            self.body = body
 
     def read_data(self) -> Any:
         if self.data:
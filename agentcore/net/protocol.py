@@ -1,6 +1,8 @@
 import asyncio
+import heapq
 import logging
-from typing import Union, Optional, Dict, Tuple
+from collections import deque
+from typing import Union, Optional, Dict, Tuple, List, Deque
 from .package import Package
 
 
@@ -11,12 +13,24 @@ class Protocol(asyncio.Protocol):
 
     _connected = False
 
+    # maximum number of requests in flight; limited by the package id space
+    max_requests = 0x10000
+
     def __init__(self):
         super().__init__()
         self._buffered_data = bytearray()
         self._package: Optional[Package] = None
-        self._requests: Dict[int, Tuple[asyncio.Future,
-                                        Optional[asyncio.Task]]] = dict()
+        self._body: Optional[bytearray] = None  # body of a large package
+        self._body_pos = 0
+        self._requests: Dict[int, asyncio.Future] = dict()
+        # heap with (deadline, pid, future) for requests with a timeout; a
+        # single timer handle is scheduled for the earliest deadline
+        self._deadlines: List[Tuple[float, int, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._write_paused = False
+        self._drain_waiters: List[asyncio.Future] = []
         self._pid = 0
         self.transport: Optional[asyncio.Transport] = None
 
@@ -32,83 +46,217 @@ class Protocol(asyncio.Protocol):
         '''
         self.transport = None
         self._package = None
+        self._body = None
+        self._body_pos = 0
         self._buffered_data.clear()
+        # nothing will be written anymore; do not keep producers waiting
+        self.resume_writing()
+
+    def pause_writing(self):
+        '''
+        override asyncio.Protocol
+        '''
+        self._write_paused = True
+
+    def resume_writing(self):
+        '''
+        override asyncio.Protocol
+        '''
+        self._write_paused = False
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def drain(self):
+        """Wait until the write buffer of the transport is below its low
+        water mark; producers of (large amounts of) data should await this
+        before writing."""
+        if not self._write_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    def write_buffer_size(self) -> int:
+        """Returns the number of bytes buffered by the transport."""
+        if self.transport is None:
+            return 0
+        return self.transport.get_write_buffer_size()
 
     def is_connected(self) -> bool:
         return self.transport is not None
 
+    def in_flight(self) -> int:
+        """Returns the number of requests waiting for a response."""
+        return len(self._requests)
+
     def request(
         self,
         pkg: Package,
         timeout: Union[None, float, int] = None
     ) -> asyncio.Future:
-        self._pid += 1
-        self._pid %= 0x10000
+        if len(self._requests) >= self.max_requests:
+            # all package id's are in use; the request is written as soon as
+            # another request is finished
+            return asyncio.ensure_future(self._request_later(pkg, timeout))
+
+        # skip package id's which are still in use by a pending request
+        while True:
+            self._pid += 1
+            self._pid %= 0x10000
+            if self._pid not in self._requests:
+                break
 
         pkg.pid = self._pid
 
-        task = asyncio.ensure_future(
-            self._timer(pkg.pid, timeout)) if timeout else None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._requests[pkg.pid] = future
 
-        future = asyncio.Future()
-        self._requests[pkg.pid] = (future, task)
+        if timeout:
+            deadline = loop.time() + timeout
+            heapq.heappush(self._deadlines, (deadline, pkg.pid, future))
+            if self._timer is None or deadline < self._timer_at:
+                self._set_timer(loop)
 
         assert self.transport is not None
-        self.transport.write(pkg.to_bytes())
+        pkg.write_to(self.transport)
 
         return future
 
+    async def _request_later(
+            self,
+            pkg: Package,
+            timeout: Union[None, float, int]):
+        while len(self._requests) >= self.max_requests:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+        return await self.request(pkg, timeout)
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
     def data_received(self, data: bytes):
         '''
         override asyncio.Protocol
         '''
-        self._buffered_data.extend(data)
-        while self._buffered_data:
-            try:
-                size = len(self._buffered_data)
-                if self._package is None:
-                    if size < Package.st_package.size:
-                        return None
-                    self._package = Package(self._buffered_data)
-                if size < self._package.total:
-                    return None
-                self._package.extract_data_from(self._buffered_data)
-            except Exception as e:
-                msg = str(e) or type(e).__name__
-                logging.error(f'data protocol error: {msg}')
-                # empty the byte-array to recover from this error
-                self._buffered_data.clear()
-            else:
+        view = memoryview(data)
+        if self._body is not None:
+            view = self._fill_body(view)
+            if self._body is not None:
+                return None
+
+        # Walk through the data using an offset and remove the handled
+        # packages only once; when nothing is buffered, packages are read
+        # directly from the received data and only the remainder is buffered.
+        buffered: Optional[bytearray] = None
+        if self._buffered_data:
+            buffered = self._buffered_data
+            buffered.extend(view)
+        buf = view if buffered is None else buffered
+        size = len(buf)
+        offset = 0
+        try:
+            while offset < size:
                 try:
-                    self.on_package_received(self._package)
+                    if self._package is None:
+                        if size - offset < Package.st_package.size:
+                            return None
+                        self._package = Package(buf, offset)
+                    if size - offset < self._package.total:
+                        if self._package.length >= Package.ZERO_COPY_SIZE:
+                            # large package; the body is collected in a
+                            # buffer of its own instead of the shared buffer
+                            start = offset + Package.st_package.size
+                            self._body = bytearray(self._package.length)
+                            with memoryview(buf) as mv:
+                                self._fill_body(mv[start:size])
+                            offset = size
+                        return None
+                    self._package.extract_data_from(buf, offset)
+                    offset += self._package.total
                 except Exception as e:
                     msg = str(e) or type(e).__name__
-                    logging.exception(f'on package handle error: {msg}')
+                    logging.error(f'data protocol error: {msg}')
+                    # skip all the data to recover from this error
+                    offset = size
+                    self._package = None
+                    self._body = None
+                    return None
+
+                pkg, self._package = self._package, None
+                self._handle_package(pkg)
+        finally:
+            if buffered is not None:
+                del buffered[:offset]
+            else:
+                self._buffered_data.extend(view[offset:])
 
-            self._package = None
+    def _fill_body(self, view: memoryview) -> memoryview:
+        assert self._package is not None and self._body is not None
+        n = min(len(view), len(self._body) - self._body_pos)
+        self._body[self._body_pos:self._body_pos + n] = view[:n]
+        self._body_pos += n
+        if self._body_pos == len(self._body):
+            pkg, self._package = self._package, None
+            pkg.body, self._body, self._body_pos = self._body, None, 0
+            self._handle_package(pkg)
+        return view[n:]
+
+    def _handle_package(self, pkg: Package):
+        try:
+            self.on_package_received(pkg)
+        except Exception as e:
+            msg = str(e) or type(e).__name__
+            logging.exception(f'on package handle error: {msg}')
 
     def on_package_received(self, pkg: Package):
         raise NotImplementedError
 
-    async def _timer(self, pid: int, timeout: Union[float, int]):
-        await asyncio.sleep(timeout)
-        try:
-            future, task = self._requests.pop(pid)
-        except KeyError:
-            logging.error(f'timed out package id not found: {pid}')
-            return None
+    def _set_timer(self, loop: asyncio.AbstractEventLoop):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._deadlines:
+            self._timer_at = self._deadlines[0][0]
+            self._timer = loop.call_at(self._timer_at, self._on_timer, loop)
 
-        future.set_exception(TimeoutError(
-            f'request timed out on package id: {pid}'))
+    def _on_timer(self, loop: asyncio.AbstractEventLoop):
+        self._timer = None
+        now = loop.time()
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, pid, future = heapq.heappop(deadlines)
+            # the request might be answered already, or the package id
+            # might be re-used by a newer request
+            if self._requests.get(pid) is not future:
+                continue
+            del self._requests[pid]
+            self._release()
+            if not future.done():
+                future.set_exception(TimeoutError(
+                    f'request timed out on package id: {pid}'))
+        self._set_timer(loop)
 
     def _get_future(self, pkg: Package) -> Optional[asyncio.Future]:
-        future, task = self._requests.pop(pkg.pid, (None, None))
+        future = self._requests.pop(pkg.pid, None)
         if future is None:
             logging.error(
                 f'got a response on package id {pkg.pid} but the original '
                 'request has probably timed-out'
             )
             return None
-        if task is not None:
-            task.cancel()
+        self._release()
         return future
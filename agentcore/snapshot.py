@@ -0,0 +1,78 @@
+"""Snapshot of the probe assets on disk.
+
+The snapshot is a base file in the same format as a full dump (probe key ->
+list of checks) plus a change log next to it. Each record in the change log
+replaces all checks for a single asset: [asset_id, {probe_key: checks}]; an
+empty mapping means the asset is removed.
+
+Writing a new base first writes a temporary file, then truncates the change
+log and finally replaces the base file. A crash in between leaves the
+previous base without changes; an older but consistent state.
+"""
+import logging
+import msgpack
+import os
+import threading
+from typing import Dict, Iterator, List
+
+_lock = threading.Lock()
+
+
+def log_fn(fn: str) -> str:
+    return os.path.splitext(fn)[0] + '.log'
+
+
+def write_base(fn: str, payloads: Dict[str, bytes]):
+    """Writes a new base; the payloads are the msgpack encoded checks for
+    each probe so the map can be written without encoding the checks."""
+    packer = msgpack.Packer()
+    tmp = f'{fn}.tmp'
+    with _lock:
+        with open(tmp, 'wb') as fp:
+            fp.write(packer.pack_map_header(len(payloads)))
+            for probe_key, payload in payloads.items():
+                fp.write(packer.pack(probe_key))
+                fp.write(payload)
+            fp.flush()
+            os.fsync(fp.fileno())
+        with open(log_fn(fn), 'wb'):
+            pass
+        os.replace(tmp, fn)
+    logging.debug(f'written assets snapshot: {fn}')
+
+
+def append_log(fn: str, records: List[list]):
+    """Appends records to the change log."""
+    packer = msgpack.Packer()
+    with _lock:
+        with open(log_fn(fn), 'ab') as fp:
+            for record in records:
+                fp.write(packer.pack(record))
+            fp.flush()
+            os.fsync(fp.fileno())
+    logging.debug(f'written {len(records)} asset change(s) to snapshot log')
+
+
+def read_log(fn: str) -> Iterator[list]:
+    """Yields the records from the change log; an incomplete record at the
+    end (crash during a write) is ignored."""
+    try:
+        fp = open(log_fn(fn), 'rb')
+    except FileNotFoundError:
+        return
+    with fp:
+        unpacker = msgpack.Unpacker(fp)
+        try:
+            for record in unpacker:
+                yield record
+        except Exception as e:
+            msg = str(e) or type(e).__name__
+            logging.warning(f'snapshot log ends with a broken record ({msg})')
+
+
+def remove(fn: str):
+    with _lock:
+        try:
+            os.remove(log_fn(fn))
+        except FileNotFoundError:
+            pass
@@ -1,9 +1,14 @@
 from __future__ import annotations
+import asyncio
+import functools
 import msgpack
 import logging
 import os
-from typing import Optional, Tuple, List, Set, Dict, TYPE_CHECKING, Any
+from typing import (
+    Optional, Tuple, List, Set, Dict, Iterator, TYPE_CHECKING, Any, Callable)
 from collections import defaultdict
+from . import snapshot
+from .check import Check
 from .zones import Zones
 if TYPE_CHECKING:
     from .connection.probeserverprotocol import ProbeServerProtocol
@@ -14,11 +19,46 @@ if TYPE_CHECKING:
 PATH_IDX, NAMES_IDX, CONFIG_IDX = range(3)
 ASSET_ID, ZONE, CHECK_ID = range(3)
 
+# on a set assets from the hub, probes receive only the changed assets unless
+# the number of changed assets exceeds this fraction of the probe's assets
+ASSETS_DELTA_MAX = float(os.getenv('ASSETS_DELTA_MAX', 0.5))
+
+# interval in seconds for writing asset changes to disk; with 0 the assets are
+# only written on shutdown
+ASSETS_SNAPSHOT_INTERVAL = float(os.getenv('ASSETS_SNAPSHOT_INTERVAL', 60))
+
+# a new base snapshot is written when the change log exceeds this number of
+# records
+ASSETS_SNAPSHOT_LOG_MAX = 10_000
+
+
+def to_lists(checks: List[Check]) -> list:
+    return [check.to_list() for check in checks]
+
+
+def packb(data: Any) -> bytes:
+    """Returns the msgpack encoded data; without a stream, msgpack always
+    returns bytes."""
+    payload = msgpack.packb(data)
+    assert payload is not None
+    return payload
+
 
 class State:
     agentcore: Optional[Agentcore] = None
     probe_connections: Set[ProbeServerProtocol] = set()
-    probe_assets: Dict[str, list] = defaultdict(list)
+    # probe_key -> asset_id -> checks; indexed by asset so an upsert or unset
+    # only touches the checks for the asset
+    probe_assets: Dict[str, Dict[int, List[Check]]] = defaultdict(dict)
+    # probe_key -> msgpack encoded checks, as sent to the probe collector
+    probe_payloads: Dict[str, bytes] = {}
+    payload_hits: int = 0
+    payload_misses: int = 0
+    # asset changes which are not yet written to the snapshot change log; only
+    # recorded when snapshots are enabled
+    assets_changes: List[list] = []
+    assets_logged: int = 0  # number of records in the snapshot change log
+    assets_base: bool = True  # a new base snapshot is required
     rapp: Optional[RappProtocol] = None
     zone: int = 0
     name: str
@@ -26,24 +66,109 @@ class State:
     agentcore_id: Optional[int] = None  # from JSON/announce
     zones: Optional[Zones] = None  # after announce
     assets_fn: Optional[str] = None
+    probes_paused: bool = False
+    draining: bool = False  # shutting down; probes stay paused
 
     @classmethod
     def set_zones(cls, agentcores: List[Tuple[int, int]]):
         assert cls.agentcore_id is not None  # is set after announce
+        if cls.zones is not None and \
+                cls.zones.same(cls.agentcore_id, cls.zone, agentcores):
+            return
         cls.zones = Zones(cls.agentcore_id, cls.zone, agentcores)
 
     @classmethod
-    def unset_assets(cls, asset_ids: list):
-        set_asset_ids = set(asset_ids)
+    def pause_probes(cls):
+        logging.warning('hub queue reached high watermark; pause probes')
+        cls.probes_paused = True
+        for conn in cls.probe_connections:
+            conn.pause()
 
-        # cleanup all assets
-        for assets in cls.probe_assets.values():
-            for i, check in reversed(list(enumerate(assets))):
-                if check[PATH_IDX][ASSET_ID] in set_asset_ids:
-                    del assets[i]
+    @classmethod
+    def drain_probes(cls):
+        """Stop reading from probe collectors before shutdown; unlike a pause
+        at the high watermark, probes are not resumed."""
+        logging.warning('stop reading from probes')
+        cls.draining = True
+        cls.probes_paused = True
+        for conn in cls.probe_connections:
+            conn.pause()
 
+    @classmethod
+    def resume_probes(cls):
+        if cls.draining:
+            return
+        logging.info('hub queue reached low watermark; resume probes')
+        cls.probes_paused = False
         for conn in cls.probe_connections:
-            conn.send_unset_assets(asset_ids)
+            conn.resume()
+
+    @classmethod
+    def probe_checks(cls, probe_key: str) -> list:
+        """Returns all checks for a probe as a flat list."""
+        assets = cls.probe_assets.get(probe_key)
+        if not assets:
+            return []
+        return [
+            check.to_list()
+            for checks in assets.values()
+            for check in checks]
+
+    @classmethod
+    def probe_payload(cls, probe_key: str) -> bytes:
+        """Returns the encoded checks for a probe; the result is cached until
+        the assets for the probe change."""
+        payload = cls.probe_payloads.get(probe_key)
+        if payload is not None:
+            cls.payload_hits += 1
+            return payload
+        cls.payload_misses += 1
+        payload = packb(cls.probe_checks(probe_key))
+        if probe_key in cls.probe_assets:
+            cls.probe_payloads[probe_key] = payload
+        return payload
+
+    @classmethod
+    def payload_stats(cls) -> Dict[str, int]:
+        return {
+            'cached': len(cls.probe_payloads),
+            'hits': cls.payload_hits,
+            'misses': cls.payload_misses,
+        }
+
+    @classmethod
+    def _remove_assets(cls, asset_ids: list) -> Set[str]:
+        """Removes the checks for the given assets and returns the probe keys
+        which had checks for at least one of the assets."""
+        probe_keys = set()
+        for probe_key, assets in cls.probe_assets.items():
+            for asset_id in asset_ids:
+                if assets.pop(asset_id, None) is not None:
+                    probe_keys.add(probe_key)
+        for probe_key in probe_keys:
+            cls.probe_payloads.pop(probe_key, None)
+        return probe_keys
+
+    @classmethod
+    def _send_unset_assets(cls, asset_ids: list, probe_keys: Set[str]):
+        conns = [
+            conn for conn in cls.probe_connections
+            if conn.probe_key in probe_keys]
+        if not conns:
+            return
+        # encode once and send the same payload to all probe collectors
+        payload = packb(asset_ids)
+        for conn in conns:
+            conn.send_unset_assets(payload)
+
+    @classmethod
+    def unset_assets(cls, asset_ids: list):
+        # cleanup all assets; only probes which had one of the assets
+        # need to be informed
+        probe_keys = cls._remove_assets(asset_ids)
+        if probe_keys and ASSETS_SNAPSHOT_INTERVAL > 0:
+            cls.assets_changes.extend([asset_id, {}] for asset_id in asset_ids)
+        cls._send_unset_assets(asset_ids, probe_keys)
 
     @classmethod
     def upsert_asset(cls, asset: list):
@@ -52,58 +177,151 @@ class State:
         asset_id, asset_zone, asset_name, probes = asset
 
         # first remove all checks for the current asset
-        for assets in cls.probe_assets.values():
-            for i, check in reversed(list(enumerate(assets))):
-                if check[PATH_IDX][ASSET_ID] == asset_id:
-                    del assets[i]
+        probe_keys = cls._remove_assets([asset_id])
 
         if not cls.zones.has_asset(asset_id, asset_zone):
-            for conn in cls.probe_connections:
-                conn.send_unset_assets([asset_id])
+            if probe_keys and ASSETS_SNAPSHOT_INTERVAL > 0:
+                cls.assets_changes.append([asset_id, {}])
+            cls._send_unset_assets([asset_id], probe_keys)
             return
 
         new = defaultdict(list)
-        for probe_key, probe_config, checks_ in probes:
-            for check_id, check_key, interval, check_config in checks_:
-                new[probe_key].append([
-                    [asset_id, check_id],
-                    [asset_name, check_key],
-                    {
-                        '_interval': interval,
-                        **(probe_config or {}),  # can be empty
-                        **(check_config or {}),  # can be empty
-                    },
-                ])
+        for probe_key, checks in cls._read_checks(
+                asset_id, asset_name, probes):
+            new[probe_key].extend(checks)
 
         for probe_key, checks in new.items():
-            cls.probe_assets[probe_key].extend(checks)
+            cls.probe_assets[probe_key][asset_id] = checks
+            cls.probe_payloads.pop(probe_key, None)
+        if (new or probe_keys) and ASSETS_SNAPSHOT_INTERVAL > 0:
+            cls.assets_changes.append([asset_id, {
+                probe_key: to_lists(checks)
+                for probe_key, checks in new.items()}])
 
+        # probes which had checks for the asset but not anymore all receive
+        # the same (empty) upsert so this payload is encoded only once
+        probe_keys.update(new)
+        empty = None
         for conn in cls.probe_connections:
-            conn.send_upsert_asset([asset_id, new[conn.probe_key]])
+            if conn.probe_key not in probe_keys:
+                continue
+            checks = new.get(conn.probe_key)
+            if checks:
+                payload = packb([asset_id, to_lists(checks)])
+            else:
+                if empty is None:
+                    empty = packb([asset_id, []])
+                payload = empty
+            conn.send_upsert_asset(payload)
+
+    @staticmethod
+    def _read_checks(
+            asset_id: int,
+            asset_name: str,
+            probes: list) -> Iterator[Tuple[str, List[Check]]]:
+        for probe_key, probe_config, checks in probes:
+            # the probe config is shared by all checks for this probe
+            probe_config = probe_config or None  # can be empty
+            yield probe_key, [
+                Check(
+                    asset_id,
+                    check_id,
+                    asset_name,
+                    check_key,
+                    interval,
+                    probe_config,
+                    check_config)
+                for check_id, check_key, interval, check_config in checks]
 
     @classmethod
     def set_assets(cls, assets: list):
         """Overwrites all the assets."""
         assert cls.zones is not None  # is set after announce
-        new = defaultdict(list)
+        new = defaultdict(dict)
         for asset_id, asset_zone, asset_name, probes in assets:
             if not cls.zones.has_asset(asset_id, asset_zone):
                 continue
-            for probe_key, probe_config, checks_ in probes:
-                for check_id, check_key, interval, check_config in checks_:
-                    new[probe_key].append([
-                        [asset_id, check_id],
-                        [asset_name, check_key],
-                        {
-                            '_interval': interval,
-                            **(probe_config or {}),  # can be empty
-                            **(check_config or {}),  # can be empty
-                        },
-                    ])
+            for probe_key, checks in cls._read_checks(
+                    asset_id, asset_name, probes):
+                new[probe_key].setdefault(asset_id, []).extend(checks)
+        old = cls.probe_assets
         cls.probe_assets = new
+        cls.probe_payloads.clear()
+        # a new base snapshot replaces all changes
+        cls.assets_changes = []
+        cls.assets_base = True
 
         for conn in cls.probe_connections:
-            conn.send_set_assets(new[conn.probe_key])
+            if conn.probe_key is None:
+                continue
+            cls._sync_probe(
+                conn,
+                old.get(conn.probe_key) or {},
+                new.get(conn.probe_key) or {})
+
+    @classmethod
+    def _sync_probe(cls, conn: ProbeServerProtocol, old: dict, new: dict):
+        probe_key = conn.probe_key
+        assert probe_key is not None  # connections without are skipped
+        changed = [
+            asset_id for asset_id, checks in new.items()
+            if old.get(asset_id) != checks]
+        removed = [asset_id for asset_id in old if asset_id not in new]
+        delta = len(changed) + len(removed)
+
+        if ASSETS_DELTA_MAX <= 0 or delta > ASSETS_DELTA_MAX * len(new):
+            logging.info(
+                f'set assets for probe collector {probe_key} <'
+                f'num assets: {len(new)} delta: {delta}>')
+            conn.send_set_assets(cls.probe_payload(probe_key))
+            return
+
+        logging.info(
+            f'delta assets for probe collector {probe_key} <'
+            f'upsert: {len(changed)} unset: {len(removed)}>')
+        if removed:
+            conn.send_unset_assets(packb(removed))
+        for asset_id in changed:
+            conn.send_upsert_asset(
+                packb([asset_id, to_lists(new[asset_id])]))
+
+    @classmethod
+    def _snapshot_job(cls) -> Optional[Callable[[], None]]:
+        """Returns a function for writing the asset changes to disk; the
+        data is collected here so the function may run in a thread."""
+        fn = cls.assets_fn
+        if fn is None:
+            return None
+
+        if cls.assets_base or cls.assets_logged + len(cls.assets_changes) > \
+                ASSETS_SNAPSHOT_LOG_MAX:
+            payloads = {k: cls.probe_payload(k) for k in cls.probe_assets}
+            cls.assets_base = False
+            cls.assets_changes = []
+            cls.assets_logged = 0
+            return functools.partial(snapshot.write_base, fn, payloads)
+
+        if cls.assets_changes:
+            changes, cls.assets_changes = cls.assets_changes, []
+            cls.assets_logged += len(changes)
+            return functools.partial(snapshot.append_log, fn, changes)
+
+        return None
+
+    @classmethod
+    async def snapshot_loop(cls):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(ASSETS_SNAPSHOT_INTERVAL)
+            job = cls._snapshot_job()
+            if job is None:
+                continue
+            try:
+                await loop.run_in_executor(None, job)
+            except Exception as e:
+                msg = str(e) or type(e).__name__
+                logging.error(f'failed to write assets snapshot: {msg}')
+                cls.assets_base = True  # retry with a new base
 
     @classmethod
     def dump_probe_assets(cls):
@@ -111,17 +329,33 @@ class State:
             logging.debug('dump file still None')
             return
 
+        if ASSETS_SNAPSHOT_INTERVAL > 0:
+            # only the changes since the last snapshot need to be written
+            job = cls._snapshot_job()
+            if job is None:
+                return
+            logging.info(f'write assets snapshot to: {cls.assets_fn}')
+            try:
+                job()
+            except Exception as e:
+                msg = str(e) or type(e).__name__
+                logging.error(f'failed to write: {cls.assets_fn} ({msg})')
+            return
+
         logging.info(f'write assets to: {cls.assets_fn}')
         try:
+            # the file keeps a flat list of checks per probe
+            data = {k: cls.probe_checks(k) for k in cls.probe_assets}
             with open(cls.assets_fn, 'wb') as fp:
-                msgpack.pack(cls.probe_assets, fp)
+                msgpack.pack(data, fp)
         except Exception as e:
             msg = str(e) or type(e).__name__
             logging.error(f'failed to write: {cls.assets_fn} ({msg})')
 
     @classmethod
     def required_probes(cls) -> Set[str]:
-        return set(key for key, items in cls.probe_assets.items() if items)
+        return set(key for key, assets in cls.probe_assets.items()
+                   if any(assets.values()))
 
     @classmethod
     def load_probe_assets(cls):
@@ -131,7 +365,20 @@ class State:
             with open(cls.assets_fn, 'rb') as fp:
                 data: dict = msgpack.unpack(fp)  # type: ignore
                 for k, v in data.items():
-                    cls.probe_assets[k] = v
+                    assets = cls.probe_assets[k] = {}
+                    cls.probe_payloads.pop(k, None)
+                    for check in map(Check.from_list, v):
+                        assets.setdefault(check.asset_id, []).append(check)
+            n = 0
+            for asset_id, probes in snapshot.read_log(cls.assets_fn):
+                cls._remove_assets([asset_id])
+                for k, v in probes.items():
+                    cls.probe_assets[k][asset_id] = \
+                        [Check.from_list(check) for check in v]
+                    cls.probe_payloads.pop(k, None)
+                n += 1
+            if n:
+                logging.info(f'applied {n} asset change(s) from snapshot log')
         except Exception as e:
             msg = str(e) or type(e).__name__
             logging.error(f'failed to read: {cls.assets_fn} ({msg})')
@@ -139,7 +386,7 @@ class State:
             for conn in cls.probe_connections:
                 if conn.probe_key is not None and \
                         conn.probe_key in cls.probe_assets:
-                    conn.send_set_assets(cls.probe_assets[conn.probe_key])
+                    conn.send_set_assets(cls.probe_payload(conn.probe_key))
 
     @classmethod
     def remove_assets_fn(cls):
@@ -152,6 +399,16 @@ class State:
                 logging.error(f'failed to remove: {cls.assets_fn} ({msg})')
             else:
                 logging.info(f'removed assets file: {cls.assets_fn}')
+        snapshot.remove(cls.assets_fn)
+
+    @classmethod
+    async def shutdown(cls):
+        """Drain the hub queue (when enabled) and stop."""
+        assert cls.agentcore is not None
+        try:
+            await cls.agentcore.drain()
+        finally:
+            cls.stop()
 
     @classmethod
     def stop(cls):
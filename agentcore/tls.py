@@ -0,0 +1,71 @@
+import logging
+import os
+import ssl
+from typing import Optional
+
+
+class SessionContext(ssl.SSLContext):
+    """SSL context which resumes the last TLS session on a new connection.
+
+    asyncio creates the SSL object using `wrap_bio` without a session; this
+    context passes the stored session so the server may resume it and skip
+    the full handshake.
+    """
+
+    session: Optional[ssl.SSLSession] = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session)
+
+
+class HubContext:
+    """Keeps the SSL context for the hub connection; the context is created
+    again only when the certificate file has changed."""
+
+    def __init__(self, crt_fn: str):
+        self._crt_fn = crt_fn
+        self._mtime: Optional[float] = None
+        self._ctx: Optional[SessionContext] = None
+
+    def get(self) -> SessionContext:
+        mtime = os.path.getmtime(self._crt_fn)
+        if self._ctx is None or mtime != self._mtime:
+            if self._ctx is not None:
+                logging.info(f'certificate changed: {self._crt_fn}')
+            ctx = SessionContext(ssl.PROTOCOL_TLS_CLIENT)
+            # use the same defaults as create_default_context(); since
+            # Python 3.13 these include stricter verify flags
+            # (VERIFY_X509_STRICT and VERIFY_X509_PARTIAL_CHAIN)
+            default = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            ctx.verify_mode = default.verify_mode
+            ctx.verify_flags = default.verify_flags
+            ctx.options = default.options
+            if default.keylog_filename:
+                ctx.keylog_filename = default.keylog_filename
+            ctx.check_hostname = False
+            ctx.load_default_certs(ssl.Purpose.SERVER_AUTH)
+            ctx.load_verify_locations(self._crt_fn)
+            self._ctx, self._mtime = ctx, mtime
+        return self._ctx
+
+    def save_session(self, ssl_object: Optional[ssl.SSLObject]):
+        """Store the session of an established connection for the next
+        connect; with TLS 1.3 the session ticket is received after the
+        handshake, so call this once data has been received."""
+        if self._ctx is None or ssl_object is None:
+            return
+        session = ssl_object.session
+        if session is not None:
+            self._ctx.session = session
+
+    def clear_session(self):
+        if self._ctx is not None:
+            self._ctx.session = None
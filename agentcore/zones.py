@@ -1,5 +1,34 @@
 import logging
-from typing import Tuple, List
+import os
+from typing import Dict, Tuple, List
+
+# asset sharding between the agentcores in a zone; must match the hub
+#   modulo: asset_id % number_of_agentcores
+#   rendezvous: highest random weight; adding or removing an agentcore only
+#               moves the assets of that agentcore
+AGENTCORE_SHARDING = os.getenv('AGENTCORE_SHARDING', 'modulo').lower()
+
+_MASK64 = (1 << 64) - 1
+
+
+def _splitmix64(x: int) -> int:
+    x = (x + 0x9e3779b97f4a7c15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+def _weight(asset_hash: int, agentcore_hash: int) -> int:
+    x = ((asset_hash ^ agentcore_hash) * 0xbf58476d1ce4e5b9) & _MASK64
+    return x ^ (x >> 29)
+
+
+def rendezvous_score(asset_id: int, agentcore_id: int) -> int:
+    """Returns the weight of an agentcore for an asset; the asset belongs to
+    the agentcore with the highest weight (the lowest agentcore Id on a tie).
+    Both Ids are hashed with splitmix64 so the hash of the agentcores can be
+    calculated once and only one multiplication per agentcore remains."""
+    return _weight(_splitmix64(asset_id), _splitmix64(agentcore_id))
 
 
 class Zones:
@@ -20,8 +49,21 @@ class Zones:
                 zones.add(ac_zone)
             all_ids.append(ac_id)
 
+        self._agentcore_id = agentcore_id
         self._zone = zone
         self._zones = zones
+        self._zone_ids = zone_ids
+        self._all_ids = all_ids
+        self._rendezvous = AGENTCORE_SHARDING == 'rendezvous'
+        self._owned: Dict[int, Tuple[int, bool]] = {}
+        self._agentcores = agentcores
+        self._hash = _splitmix64(agentcore_id)
+        self._zone_hashes = [
+            (ac_id, _splitmix64(ac_id))
+            for ac_id in zone_ids if ac_id != agentcore_id]
+        self._all_hashes = [
+            (ac_id, _splitmix64(ac_id))
+            for ac_id in all_ids if ac_id != agentcore_id]
 
         self._zone_mod = len(zone_ids)
         self._all_mod = len(all_ids)
@@ -38,8 +80,48 @@ class Zones:
             self._all_idx = None
 
     def has_asset(self, asset_id: int, asset_zone: int) -> bool:
+        if self._rendezvous:
+            return self._has_asset_rendezvous(asset_id, asset_zone)
         if asset_zone == self._zone:
             return asset_id % self._zone_mod == self._zone_idx
         if asset_zone not in self._zones:
             return asset_id % self._all_mod == self._all_idx
         return False
+
+    def _has_asset_rendezvous(self, asset_id: int, asset_zone: int) -> bool:
+        # the result is cached; a new Zones instance is created when the
+        # agentcores change
+        cached = self._owned.get(asset_id)
+        if cached is not None and cached[0] == asset_zone:
+            return cached[1]
+        owned = self._is_owner(asset_id, asset_zone)
+        self._owned[asset_id] = (asset_zone, owned)
+        return owned
+
+    def _is_owner(self, asset_id: int, asset_zone: int) -> bool:
+        if self._zone_idx is None:
+            return False
+        if asset_zone == self._zone:
+            others = self._zone_hashes
+        elif asset_zone not in self._zones:
+            others = self._all_hashes
+        else:
+            return False
+        # stop at the first agentcore with a higher weight; most assets are
+        # owned by another agentcore so only a few weights are calculated
+        me = self._agentcore_id
+        asset_hash = _splitmix64(asset_id)
+        mine = _weight(asset_hash, self._hash)
+        for ac_id, ac_hash in others:
+            weight = _weight(asset_hash, ac_hash)
+            if weight > mine or weight == mine and ac_id < me:
+                return False
+        return True
+
+    def same(self, agentcore_id: int, zone: int,
+             agentcores: List[Tuple[int, int]]) -> bool:
+        """Returns True when this instance is created with the same input;
+        it can then be kept, including the cached ownership of assets."""
+        return self._agentcore_id == agentcore_id and \
+            self._zone == zone and \
+            self._agentcores == sorted(agentcores)
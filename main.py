@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import sys
@@ -29,10 +30,22 @@ if AGENTCORE_NAME is None:
         'Please use the `AGENTCORE_NAME` to provide a name.')
 
 
+_shutdown_fut = None
+
+
+def shutdown():
+    global _shutdown_fut
+    if _shutdown_fut is not None:
+        logging.warning('already stopping')
+        return
+    _shutdown_fut = asyncio.ensure_future(State.shutdown())
+    _shutdown_fut.add_done_callback(lambda _: loop.stop())
+
+
 def stop(signame, *args):
     logging.warning(f'signal \'{signame}\' received, stop agentcore')
-    State.stop()
-    loop.close()
+    # signal handlers do not run in the event loop
+    loop.call_soon_threadsafe(shutdown)
 
 
 if __name__ == '__main__':